@@ -1,18 +1,34 @@
+import importlib
+from typing import TYPE_CHECKING, Any
+
 from .convert2mp4file import ConvertToMp4File
 from .convert2wavefile import ConvertToWavFile
 from .speaker_integrator import SpeakerIntegrator
 from .speaker_segment import SpeakerSegment
 from .speaker_segment_file import SpeakerSegmentFile
-from .speaker_seperator import SpeakerSeperator
 from .speaker_text import SpeakerText
 from .speech_integrator import SpeechIntegrator
 from .speech_text_file import SpeechTextFile
 from .speech_text_writer import SpeechTextWriter
 from .speech_to_text import SpeechToText
+from .whisper_cpp_server_speech_to_text import WhisperCppServerSpeechToText
+
+if TYPE_CHECKING:
+    from .faster_whisper_speech_to_text import FasterWhisperSpeechToText
+    from .speaker_seperator import SpeakerSeperator
+    from .waveform import Waveform
+
+# torchやfaster-whisperの読み込みには時間がかかるため、利用されるまで読み込まない
+_LAZY_MODULES = {
+    "FasterWhisperSpeechToText": ".faster_whisper_speech_to_text",
+    "SpeakerSeperator": ".speaker_seperator",
+    "Waveform": ".waveform",
+}
 
 __all__ = [
     "ConvertToWavFile",
     "ConvertToMp4File",
+    "FasterWhisperSpeechToText",
     "SpeakerIntegrator",
     "SpeakerSegment",
     "SpeakerSegmentFile",
@@ -21,5 +37,18 @@ __all__ = [
     "SpeechIntegrator",
     "SpeechTextFile",
     "SpeechTextWriter",
-    "SpeechToText"
+    "SpeechToText",
+    "Waveform",
+    "WhisperCppServerSpeechToText",
 ]
+
+
+def __getattr__(name: str) -> Any:
+    if name not in _LAZY_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module = importlib.import_module(_LAZY_MODULES[name], __name__)
+    attr = getattr(module, name)
+    globals()[name] = attr
+
+    return attr
@@ -8,34 +8,66 @@ _logger = logging.getLogger(__name__)
 class ConvertToMp4File:
     """指定したファイルをmp4に変換する."""
 
-    def __init__(self, output_dir: Path) -> None:
+    def __init__(self, output_dir: Path, device_name: str = "cpu") -> None:
         self._output_dir = output_dir
+        self._device_name = device_name
 
     def convert(self, filepath: Path) -> Path:
         output_filepath = self._output_dir / f"{filepath.stem}.mp4"
+        if self._device_name == "cuda":
+            # ffmpegがNVENC/NVDEC付きでビルドされているとは限らないため、
+            # 失敗した場合はCPUでの変換にフォールバックする
+            try:
+                self._run(self._build_command(filepath, output_filepath, True))
+                return output_filepath
+            except subprocess.CalledProcessError as e:
+                _logger.warning(
+                    f"hardware conversion failed with exit status {e.returncode}."
+                    " fallback to cpu."
+                )
+                _logger.debug(e.stderr)
+
+        try:
+            self._run(self._build_command(filepath, output_filepath, False))
+        except subprocess.CalledProcessError as e:
+            _logger.error(f"command failed with exit status {e.returncode}")
+            _logger.error(e.stderr)
+            raise ValueError("error converting to mp4 file.") from e
+
+        return output_filepath
+
+    def _build_command(
+        self, filepath: Path, output_filepath: Path, use_cuda: bool
+    ) -> list[str]:
+        # cudaを利用する場合はNVDEC/NVENCでデコードとエンコードを行う
+        # 音声はmp4に格納できないコーデック(Vorbis, PCMなど)もあるため、AACに変換する
+        hwaccel_args = (
+            ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"] if use_cuda else []
+        )
+        codec_args = (
+            ["-c:v", "hevc_nvenc", "-preset", "p1", "-cq", "34", "-c:a", "aac"]
+            if use_cuda
+            else []
+        )
         command_args = [
             "ffmpeg",
             "-y",  # 既存ファイルが存在する場合などで入力が必要となる部分を全てYesで進める
+            *hwaccel_args,
             "-i",
             f"{str(filepath.resolve())}",
+            *codec_args,
             str(output_filepath.resolve()),
         ]
-        proc = subprocess.Popen(
+
+        return command_args
+
+    def _run(self, command_args: list[str]) -> None:
+        # 標準出力は利用しないため破棄し、標準エラーはエラー時のみ出力する
+        subprocess.run(
             command_args,
+            check=True,
             encoding="utf-8",
-            stdout=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
             stderr=subprocess.PIPE,
+            timeout=1800,
         )
-        try:
-            result, error = proc.communicate(timeout=1800)
-            if proc.returncode != 0:
-                _logger.error(f"command failed with exit status {proc.returncode}")
-                _logger.error(error)
-                raise ValueError("error converting to wav file.")
-        except Exception:
-            proc.kill()
-            raise
-        _logger.info(f"stdout: {result}")
-        _logger.warning(f"stderr: {result}")
-
-        return output_filepath
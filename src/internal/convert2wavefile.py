@@ -6,7 +6,7 @@ _logger = logging.getLogger(__name__)
 
 
 class ConvertToWavFile:
-    """指定したファイルをwav 16bitに変換する."""
+    """指定したファイルをwav 16bit, 16kHz, monoに変換する."""
 
     def __init__(self, output_dir: Path) -> None:
         self._output_dir = output_dir
@@ -18,28 +18,35 @@ class ConvertToWavFile:
             "-y",  # 既存ファイルが存在する場合などで入力が必要となる部分を全てYesで進める
             "-i",
             f"{str(filepath.resolve())}",
+            # 音声のみ利用するため、映像と字幕は処理せず最初の音声ストリームのみ変換する
+            "-map",
+            "0:a:0",
+            "-vn",
+            "-sn",
+            "-threads",
+            "0",
+            # 話者分離とwhisperの入力形式(16kHz, mono)に合わせ、後段での変換を不要にする
+            "-ac",
+            "1",
             "-ar",
             "16000",
             "-c:a",
             "pcm_s16le",
             str(output_filepath.resolve()),
         ]
-        proc = subprocess.Popen(
-            command_args,
-            encoding="utf-8",
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
+        # 標準出力は利用しないため破棄し、標準エラーはエラー時のみ出力する
         try:
-            result, error = proc.communicate(timeout=1800)
-            if proc.returncode != 0:
-                _logger.error(f"command failed with exit status {proc.returncode}")
-                _logger.error(error)
-                raise ValueError("error converting to wav file.")
-        except Exception:
-            proc.kill()
-            raise
-        _logger.info(f"stdout: {result}")
-        _logger.warning(f"stderr: {result}")
+            subprocess.run(
+                command_args,
+                check=True,
+                encoding="utf-8",
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                timeout=1800,
+            )
+        except subprocess.CalledProcessError as e:
+            _logger.error(f"command failed with exit status {e.returncode}")
+            _logger.error(e.stderr)
+            raise ValueError("error converting to wav file.") from e
 
         return output_filepath
@@ -0,0 +1,319 @@
+import logging
+from collections.abc import Iterator
+
+import numpy as np
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+from internal.speaker_segment import SpeakerSegment
+from internal.speaker_text import SpeakerText
+from internal.timestamp_text import assign_by_center_time
+from internal.waveform import Waveform
+
+_logger = logging.getLogger(__name__)
+
+
+class FasterWhisperSpeechToText:
+    """faster-whisperを利用してプロセス内で書き起こしを行う.
+
+    Notes
+    -----
+    モデルの読み込みには時間がかかるため、読み込んだモデルはクラスで保持し、
+    同じデバイスとモデルであればファイルをまたいで再利用する。
+    """
+
+    _model: WhisperModel | None = None
+    _model_key: tuple[str, str] | None = None
+
+    def __init__(
+        self,
+        model_name: str,
+        device_name: str,
+        batch_size: int = 1,
+        silence_threshold: float = -40.0,
+        playback_speed: float = 1.0,
+        speedup_min_duration: float = 20.0,
+        min_infer_duration: float = 5.0,
+    ) -> None:
+        self._model_name = model_name
+        # faster-whisper(CTranslate2)はmpsに対応していないためcpuで処理する
+        self._device_name = "cuda" if device_name == "cuda" else "cpu"
+        # 2以上の場合は複数の区間をまとめてバッチ推論する
+        self._batch_size = batch_size
+
+        # whisperのエンコーダは入力長に比例して時間がかかるため、区間ごとに推論する場合は
+        # 前後の無音を除去し、長い区間は再生速度を上げて入力を短くする
+        self._silence_threshold = silence_threshold  # dBFS
+        self._playback_speed = playback_speed
+        self._speedup_min_duration = speedup_min_duration  # 秒
+        # whisperは入力を30秒に揃えて推論するため、短い区間は隣接する区間とまとめて推論する
+        self._min_infer_duration = min_infer_duration  # 秒
+
+    @classmethod
+    def _get_model(cls, device_name: str, model_name: str) -> WhisperModel:
+        """読み込み済みのモデルを返す. 条件が異なる場合は読み込み直す."""
+        model_key = (device_name, model_name)
+        if cls._model is None or cls._model_key != model_key:
+            compute_type = "float16" if device_name == "cuda" else "int8"
+            _logger.info(f"load whisper model: {model_name} ({compute_type})")
+            cls._model = WhisperModel(
+                model_name, device=device_name, compute_type=compute_type
+            )
+            cls._model_key = model_key
+
+        return cls._model
+
+    def to_text(
+        self, waveform: Waveform, segments: list[SpeakerSegment]
+    ) -> Iterator[SpeakerText]:
+        """指定した音源をテキスト化する."""
+        model = self._get_model(self._device_name, self._model_name)
+        # whisperの入力は16kHz, mono, 16bitとする
+        # Waveform.to_numpyのint16配列から区間ごとにviewを切り出し、コピーを避ける
+        sample_rate = 16000
+        samples = waveform.to_numpy(sample_rate)
+
+        if self._batch_size > 1:
+            segment_texts = self._batched_segments_to_text(
+                model, samples, sample_rate, segments
+            )
+        else:
+            segment_texts = self._segments_to_text(
+                model, samples, sample_rate, segments
+            )
+        for segment, text in segment_texts:
+            speaker_text = SpeakerText(
+                start_time=segment.start_time,
+                end_time=segment.end_time,
+                speaker_name=segment.speaker_name,
+                text=text,
+            )
+            _logger.debug(
+                f"[{segment.start_time:03.1f}s - {segment.end_time:03.1f}s]"
+                f" {segment.speaker_name} : {text}"
+            )
+            yield speaker_text
+
+    def _batched_segments_to_text(
+        self,
+        model: WhisperModel,
+        samples: np.ndarray,
+        sample_rate: int,
+        segments: list[SpeakerSegment],
+    ) -> Iterator[tuple[SpeakerSegment, str]]:
+        """話者区間を30秒以下に分割し、まとめてバッチ推論する.
+
+        Notes
+        -----
+        書き起こし結果は、中央時刻が含まれる話者区間に割り当てる。
+        """
+        max_clip_length = 30 * sample_rate  # whisperの入力長
+        clip_timestamps: list[dict[str, int]] = list()
+        for segment in segments:
+            start_index = int(segment.start_time * sample_rate)
+            end_index = int(segment.end_time * sample_rate)
+            for clip_start in range(start_index, end_index, max_clip_length):
+                clip_end = min(clip_start + max_clip_length, end_index)
+                clip_timestamps.append({"start": clip_start, "end": clip_end})
+        if len(clip_timestamps) < 1:
+            return
+
+        pipeline = BatchedInferencePipeline(model=model)
+        result_segments, _ = pipeline.transcribe(
+            samples.astype(np.float32) / 32768.0,
+            language="ja",
+            batch_size=self._batch_size,
+            clip_timestamps=clip_timestamps,
+        )
+        timestamp_texts = [
+            (result.start, result.end, result.text.strip())
+            for result in result_segments
+        ]
+        yield from assign_by_center_time(timestamp_texts, segments)
+
+    def _coalesced_segments_to_text(
+        self,
+        model: WhisperModel,
+        samples: np.ndarray,
+        sample_rate: int,
+        segments: list[SpeakerSegment],
+    ) -> Iterator[tuple[SpeakerSegment, str]]:
+        """連続する短い区間をまとめて推論し、中央時刻が含まれる区間にテキストを割り当てる."""
+        group_start_time = segments[0].start_time
+        start_index = int(group_start_time * sample_rate)
+        end_index = int(max(segment.end_time for segment in segments) * sample_rate)
+        audio = samples[start_index:end_index].astype(np.float32) / 32768.0
+        try:
+            result_segments, _ = model.transcribe(audio, language="ja")
+            timestamp_texts = [
+                (
+                    group_start_time + result.start,
+                    group_start_time + result.end,
+                    result.text.strip(),
+                )
+                for result in result_segments
+            ]
+        except Exception:
+            _logger.exception(
+                "Unhandled exception in speech to text. continue..."
+                f" [{group_start_time:03.1f}s - {end_index / sample_rate:03.1f}s]"
+            )
+            return
+        yield from assign_by_center_time(timestamp_texts, segments)
+
+    def _segments_to_text(
+        self,
+        model: WhisperModel,
+        samples: np.ndarray,
+        sample_rate: int,
+        segments: list[SpeakerSegment],
+    ) -> Iterator[tuple[SpeakerSegment, str]]:
+        """話者区間を1つずつ推論する. 短い区間は隣接する区間とまとめて推論する."""
+        for group in _coalesce_segments(segments, self._min_infer_duration):
+            if len(group) > 1:
+                yield from self._coalesced_segments_to_text(
+                    model, samples, sample_rate, group
+                )
+                continue
+
+            segment = group[0]
+            start_index = int(segment.start_time * sample_rate)
+            end_index = int(segment.end_time * sample_rate)
+            segment_samples = _trim_silence(
+                samples[start_index:end_index], sample_rate, self._silence_threshold
+            )
+            if len(segment_samples) < 1:
+                # 無音の区間は推論しない
+                yield segment, ""
+                continue
+            if (
+                self._playback_speed > 1.0
+                and len(segment_samples) > self._speedup_min_duration * sample_rate
+            ):
+                segment_samples = _speedup(
+                    segment_samples, sample_rate, self._playback_speed
+                )
+            try:
+                text = self._sound_segment_to_text(model, segment_samples)
+            except Exception:
+                _logger.exception(
+                    "Unhandled exception in speech to text. continue..."
+                    f" [{segment.start_time:03.1f}s - {segment.end_time:03.1f}s]"
+                    f" {segment.speaker_name}"
+                )
+                continue
+            yield segment, text
+
+    def _sound_segment_to_text(self, model: WhisperModel, samples: np.ndarray) -> str:
+        """1つ分のオーディオデータ(16kHz, mono, int16)をテキスト化する."""
+        audio = samples.astype(np.float32) / 32768.0
+        result_segments, _ = model.transcribe(audio, language="ja")
+        match_str = " ".join(segment.text.strip() for segment in result_segments)
+
+        return match_str
+
+
+def _coalesce_segments(
+    segments: list[SpeakerSegment], min_duration: float, max_duration: float = 30.0
+) -> Iterator[list[SpeakerSegment]]:
+    """min_duration未満の連続する区間を、max_duration以内に収まる範囲でまとめる.
+
+    Notes
+    -----
+    min_duration以上の区間は無音除去や再生速度の変更を行うため、まとめずに1区間ずつ返す。
+    """
+    group: list[SpeakerSegment] = list()
+    for segment in segments:
+        if segment.end_time - segment.start_time >= min_duration:
+            if len(group) > 0:
+                yield group
+                group = list()
+            yield [segment]
+            continue
+
+        if len(group) > 0 and segment.end_time - group[0].start_time > max_duration:
+            yield group
+            group = list()
+        group.append(segment)
+    if len(group) > 0:
+        yield group
+
+
+def _speedup(
+    samples: np.ndarray,
+    sample_rate: int,
+    playback_speed: float,
+    chunk_duration: float = 0.15,
+    crossfade_duration: float = 0.025,
+) -> np.ndarray:
+    """音程を変えずに再生速度を上げる.
+
+    Notes
+    -----
+    pydubのspeedupと同様に、一定長のchunkごとに末尾を間引き、隣接するchunkをクロスフェードでつなぐ。
+    chunkを1つずつ連結すると連結のたびに全体がコピーされるため、numpyの配列操作でまとめて処理する。
+    """
+    chunk_length = int(chunk_duration * sample_rate)
+    remove_length = int(chunk_length * (playback_speed - 1.0))
+    crossfade_length = min(int(crossfade_duration * sample_rate), remove_length - 1)
+    stride = chunk_length + remove_length
+    num_chunks = len(samples) // stride
+    if crossfade_length < 1 or num_chunks < 2:
+        return samples
+
+    audio = samples.astype(np.float32)
+    chunked_length = num_chunks * stride
+    tail_end = chunk_length + crossfade_length
+    # 各chunkは先頭からchunk長とクロスフェード分のみ残す
+    chunks = audio[:chunked_length].reshape(num_chunks, stride)
+    heads = chunks[:, :crossfade_length]
+    bodies = chunks[:, crossfade_length:chunk_length]
+    tails = chunks[:, chunk_length:tail_end]
+
+    fade_in = np.linspace(0.0, 1.0, crossfade_length, dtype=np.float32)
+    blended_heads = np.empty_like(heads)
+    blended_heads[0] = heads[0]
+    blended_heads[1:] = tails[:-1] * (1.0 - fade_in) + heads[1:] * fade_in
+    output = np.concatenate(
+        [
+            np.concatenate([blended_heads, bodies], axis=1).reshape(-1),
+            tails[-1],
+            audio[chunked_length:],
+        ]
+    )
+
+    return np.clip(np.round(output), -32768, 32767).astype(np.int16)
+
+
+def _trim_silence(
+    samples: np.ndarray,
+    sample_rate: int,
+    silence_threshold: float,
+    padding: float = 0.2,
+) -> np.ndarray:
+    """前後の無音を除去する. 全て無音の場合は空の配列を返す.
+
+    Notes
+    -----
+    10ms単位のフレームの音量(dBFS)が閾値を超える最初と最後のフレームを探し、
+    前後にpadding秒の余白を残して切り出す。
+    """
+    frame_length = sample_rate // 100
+    num_frames = len(samples) // frame_length
+    if num_frames < 1:
+        return samples[:0]
+
+    frames = samples[: num_frames * frame_length].reshape(num_frames, frame_length)
+    rms = np.sqrt(np.mean(frames.astype(np.float32) ** 2, axis=1))
+    with np.errstate(divide="ignore"):
+        dbfs = 20 * np.log10(rms / 32768.0)
+    voiced_frames = np.flatnonzero(dbfs > silence_threshold)
+    if len(voiced_frames) < 1:
+        return samples[:0]
+
+    padding_length = int(padding * sample_rate)
+    start_index = max(voiced_frames[0] * frame_length - padding_length, 0)
+    end_index = min(
+        (voiced_frames[-1] + 1) * frame_length + padding_length, len(samples)
+    )
+
+    return samples[start_index:end_index]
@@ -1,9 +1,15 @@
+from collections.abc import Callable
+
+import numpy as np
+
 from internal.speaker_segment import SpeakerSegment
 
 
 class SpeakerIntegrator:
     """話者分離情報をテキスト化しやすいように統合する."""
 
+    _merge_func: Callable[..., tuple[np.ndarray, np.ndarray]] | None = None
+
     def __init__(
         self,
         segment_duration_threshold: float = 60.0,
@@ -14,50 +20,103 @@ class SpeakerIntegrator:
         self._split_segment_duration = split_segment_duration
         self._max_segment_duration = max_segment_duration
 
+    @classmethod
+    def _get_merge(cls) -> Callable[..., tuple[np.ndarray, np.ndarray]]:
+        """統合処理を返す. numbaがある場合はコンパイルした関数を返す.
+
+        Notes
+        -----
+        numbaの読み込みには時間がかかるため、モジュールの読み込み時ではなく初回の統合時に読み込む。
+        コンパイル結果はクラスで保持し、キャッシュして再利用する。
+        """
+        if cls._merge_func is None:
+            try:
+                from numba import njit
+            except ImportError:  # numbaがない場合はPythonのループで統合する
+                cls._merge_func = _merge
+            else:
+                cls._merge_func = njit(cache=True)(_merge)
+
+        return cls._merge_func
+
     def integrate(self, segments: list[SpeakerSegment]) -> list[SpeakerSegment]:
         """連続する話者区間を統合する."""
         if len(segments) < 1:
             return list()
 
-        new_segments: list[SpeakerSegment] = [segments[0]]
-        is_force_split = False
-        for segment in segments[1:]:
-            current_segment = new_segments[-1]
-
-            # 強制的に分割する場合
-            if is_force_split:
-                new_segments.append(segment)
-                is_force_split = False
-                continue
-
-            # 話者が変わった場合は分割
-            if current_segment.speaker_name != segment.speaker_name:
-                new_segments.append(segment)
-                is_force_split = False
-                continue
-
-            # 閾値以下であればsegmentを統合
-            total_duration = segment.end_time - current_segment.start_time
-            if total_duration < self._segment_duration_threshold:
-                current_segment.end_time = segment.end_time
-                is_force_split = False
-                continue
-
-            # しきい値を超えている場合に短い区間だったら統合して次で分割
-            segment_duration = segment.end_time - segment.start_time
-            if segment_duration < self._split_segment_duration:
-                current_segment.end_time = segment.end_time
-                is_force_split = True
-                continue
-
-            # maxより小さければ統合
-            if total_duration < self._max_segment_duration:
-                current_segment.end_time = segment.end_time
-                is_force_split = False
-                continue
-
-            # maxを超えていて統合できるポイントがなかったので強制分割
-            new_segments.append(segment)
+        # pydanticのモデルを1件ずつ更新せず、開始時刻、終了時刻、話者IDの配列で統合する
+        starts = np.array([segment.start_time for segment in segments])
+        ends = np.array([segment.end_time for segment in segments])
+        speaker_names, speaker_ids = np.unique(
+            [segment.speaker_name for segment in segments], return_inverse=True
+        )
+        keep_indices, new_ends = self._get_merge()(
+            starts,
+            ends,
+            speaker_ids,
+            self._segment_duration_threshold,
+            self._split_segment_duration,
+            self._max_segment_duration,
+        )
+
+        return [
+            SpeakerSegment(
+                start_time=float(starts[index]),
+                end_time=float(end_time),
+                speaker_name=str(speaker_names[speaker_ids[index]]),
+            )
+            for index, end_time in zip(keep_indices, new_ends)
+        ]
+
+
+def _merge(
+    starts: np.ndarray,
+    ends: np.ndarray,
+    speaker_ids: np.ndarray,
+    segment_duration_threshold: float,
+    split_segment_duration: float,
+    max_segment_duration: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """統合後の区間の先頭となる区間のindexと、統合後の終了時刻を返す."""
+    num_segments = len(starts)
+    is_speaker_changed = speaker_ids[1:] != speaker_ids[:-1]
+    durations = ends - starts
+
+    keep_indices = np.empty(num_segments, dtype=np.int64)
+    new_ends = np.empty(num_segments, dtype=np.float64)
+    keep_indices[0] = 0
+    new_ends[0] = ends[0]
+    num_keep = 1
+    is_force_split = False
+    for index in range(1, num_segments):
+        # 強制的に分割する場合と話者が変わった場合は分割
+        if is_force_split or is_speaker_changed[index - 1]:
+            keep_indices[num_keep] = index
+            new_ends[num_keep] = ends[index]
+            num_keep += 1
             is_force_split = False
+            continue
+
+        # 閾値以下であればsegmentを統合
+        total_duration = ends[index] - starts[keep_indices[num_keep - 1]]
+        if total_duration < segment_duration_threshold:
+            new_ends[num_keep - 1] = ends[index]
+            continue
+
+        # しきい値を超えている場合に短い区間だったら統合して次で分割
+        if durations[index] < split_segment_duration:
+            new_ends[num_keep - 1] = ends[index]
+            is_force_split = True
+            continue
+
+        # maxより小さければ統合
+        if total_duration < max_segment_duration:
+            new_ends[num_keep - 1] = ends[index]
+            continue
+
+        # maxを超えていて統合できるポイントがなかったので強制分割
+        keep_indices[num_keep] = index
+        new_ends[num_keep] = ends[index]
+        num_keep += 1
 
-        return new_segments
+    return keep_indices[:num_keep], new_ends[:num_keep]
@@ -1,32 +1,78 @@
 from pathlib import Path
 
-from pydantic import RootModel
+import orjson
 
 from internal.speaker_segment import SpeakerSegment
 
 
 class SpeakerSegmentFile:
-    """話者分離情報をファイルに保存する."""
+    """話者分離情報をファイルに保存する.
 
-    class SpeakerSegmentList(RootModel[list[SpeakerSegment]]):
-        pass
+    Notes
+    -----
+    1行に1区間を記録するJSON Lines形式で保存する。
+    appendで追記した結果は作業中のファイルに保存し、completeで確定する。
+    """
 
     def __init__(self, filepath: Path) -> None:
         self._filepath = filepath
+        self._partial_filepath = filepath.with_name(f"{filepath.name}.partial")
 
     def save(self, segments: list[SpeakerSegment]) -> None:
-        segment_list = self.SpeakerSegmentList.model_validate(segments)
-        self._filepath.write_text(segment_list.json())
+        # 改行はorjsonで付与し、行ごとにbytesを連結し直さない
+        self._filepath.write_bytes(
+            b"".join(
+                orjson.dumps(segment.model_dump(), option=orjson.OPT_APPEND_NEWLINE)
+                for segment in segments
+            )
+        )
+
+    def append(self, segment: SpeakerSegment) -> None:
+        """1区間分の結果を作業中のファイルに追記する."""
+        with self._partial_filepath.open("ab") as f:
+            f.write(
+                orjson.dumps(segment.model_dump(), option=orjson.OPT_APPEND_NEWLINE)
+            )
+
+    def complete(self) -> None:
+        """作業中のファイルに追記した結果を確定する."""
+        if not self._partial_filepath.exists():
+            self._filepath.write_bytes(b"")
+            return
+
+        self._partial_filepath.replace(self._filepath)
 
     def get_segment_list(self) -> list[SpeakerSegment]:
         if not self._filepath.exists():
             return list()
 
-        segment_list = self.SpeakerSegmentList.parse_file(self._filepath)
-        return segment_list.root
+        return self._read_lines(self._filepath.read_bytes())
+
+    def get_partial_segment_list(self) -> list[SpeakerSegment]:
+        """中断した処理を再開するため、作業中のファイルに追記済みの結果を返す."""
+        if not self._partial_filepath.exists():
+            return list()
+
+        data = self._partial_filepath.read_bytes()
+        complete_size = data.rfind(b"\n") + 1
+        if complete_size < len(data):
+            # 書き込み途中で中断した行は破棄する
+            with self._partial_filepath.open("r+b") as f:
+                f.truncate(complete_size)
+
+        return self._read_lines(data[:complete_size])
 
     def clean(self) -> None:
+        self._partial_filepath.unlink(missing_ok=True)
         if not self._filepath.exists():
             return
 
         self._filepath.unlink()
+
+    def _read_lines(self, data: bytes) -> list[SpeakerSegment]:
+        # 本スクリプトで保存したファイルのみ読み込むため、検証を省略してモデルを生成する
+        return [
+            SpeakerSegment.model_construct(**orjson.loads(line))
+            for line in data.splitlines()
+            if line
+        ]
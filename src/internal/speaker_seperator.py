@@ -1,25 +1,280 @@
+import gc
+import logging
 from pathlib import Path
 
+import numpy as np
 import torch
+import torchaudio
 from pyannote.audio import Pipeline
 
 from internal.speaker_segment import SpeakerSegment
+from internal.waveform import Waveform
+
+_logger = logging.getLogger(__name__)
+
+_PIPELINE_SAMPLE_RATE = 16000  # pyannoteのモデルが想定するサンプリング周波数
 
 
 class SpeakerSeperator:
-    """音声から話者分離を行う."""
+    """音声から話者分離を行う.
+
+    Notes
+    -----
+    pipelineの構築とデバイスへの転送には時間がかかるため、構築したpipelineはクラスで保持し、
+    同じ設定ファイルとデバイスであればファイルをまたいで再利用する。
+    """
 
-    def __init__(self, config_path: Path, device_name: str) -> None:
+    _pipeline: Pipeline | None = None
+    _pipeline_key: tuple[Path, str] | None = None
+
+    def __init__(
+        self,
+        config_path: Path,
+        device_name: str,
+        num_speakers: int | None = None,
+        min_speakers: int | None = None,
+        max_speakers: int | None = None,
+        max_chunk_duration: float | None = None,
+        speaker_similarity_threshold: float = 0.3,
+        embedding_batch_size: int | None = None,
+        segmentation_batch_size: int | None = None,
+    ) -> None:
         self._config_path = config_path
         self._device_name = device_name
 
-    def diarization(self, wav_filepath: Path):
-        pipeline = Pipeline.from_pretrained(self._config_path)
-        pipeline.to(torch.device(self._device_name))
-        diarization = pipeline(wav_filepath)
+        # 話者数が分かっている場合はクラスタリングの探索範囲を絞り込む
+        self._num_speakers = num_speakers
+        self._min_speakers = min_speakers
+        self._max_speakers = max_speakers
+
+        # 長い音源は無音付近で分割して話者分離し、話者埋め込みの類似度で話者を対応付ける
+        # 類似度の閾値はpyannote 3.1のクラスタリング閾値(コサイン距離で約0.7)に合わせる
+        self._max_chunk_duration = max_chunk_duration
+        self._speaker_similarity_threshold = speaker_similarity_threshold
+
+        # 話者埋め込みの推論が処理時間の大半を占めるため、GPUのメモリに応じてバッチを大きくする
+        default_batch_size = _default_batch_size(device_name)
+        self._embedding_batch_size = embedding_batch_size or default_batch_size
+        self._segmentation_batch_size = segmentation_batch_size or default_batch_size
+
+    @classmethod
+    def _get_pipeline(cls, config_path: Path, device_name: str) -> Pipeline:
+        """構築済みのpipelineを返す. 条件が異なる場合は構築し直す."""
+        pipeline_key = (config_path.resolve(), device_name)
+        if cls._pipeline is None or cls._pipeline_key != pipeline_key:
+            cls.unload()
+            _logger.info(f"load pipeline: {config_path} ({device_name})")
+            pipeline = Pipeline.from_pretrained(config_path)
+            pipeline.to(torch.device(device_name))
+            cls._pipeline = pipeline
+            cls._pipeline_key = pipeline_key
+
+        return cls._pipeline
+
+    @classmethod
+    def unload(cls) -> None:
+        """保持しているpipelineを解放する."""
+        if cls._pipeline is None:
+            return
+
+        cls._pipeline = None
+        cls._pipeline_key = None
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
-        for segment, _, speaker in diarization.itertracks(yield_label=True):
-            speaker_segment = SpeakerSegment(
-                start_time=segment.start, end_time=segment.end, speaker_name=speaker
+    def diarization(self, waveform: Waveform):
+        pipeline = self._get_pipeline(self._config_path, self._device_name)
+        pipeline.embedding_batch_size = self._embedding_batch_size
+        pipeline.segmentation_batch_size = self._segmentation_batch_size
+        # ファイルパスを渡すとpipeline内で再度デコードされるため、デコード済みの波形を渡す
+        tensor = _prepare_waveform(waveform, self._device_name)
+        if self._max_chunk_duration is None:
+            diarization = pipeline(
+                {"waveform": tensor, "sample_rate": _PIPELINE_SAMPLE_RATE},
+                num_speakers=self._num_speakers,
+                min_speakers=self._min_speakers,
+                max_speakers=self._max_speakers,
             )
-            yield speaker_segment
+            for segment, _, speaker in diarization.itertracks(yield_label=True):
+                speaker_segment = SpeakerSegment(
+                    start_time=segment.start, end_time=segment.end, speaker_name=speaker
+                )
+                yield speaker_segment
+            return
+
+        yield from self._chunked_diarization(pipeline, tensor)
+
+    def _chunked_diarization(self, pipeline: Pipeline, tensor: torch.Tensor):
+        """音源を分割して話者分離し、分割間で話者を対応付ける."""
+        assert self._max_chunk_duration is not None
+
+        sample_rate = _PIPELINE_SAMPLE_RATE
+        split_points = _find_split_points(tensor, sample_rate, self._max_chunk_duration)
+        # 分割後の各区間に全話者が含まれるとは限らないため、最大話者数のみを制約とする
+        max_speakers = self._max_speakers or self._num_speakers
+        # 全体の話者数の上限. 上限に達した後は新しい話者ラベルを作らない
+        max_global_speakers = self._num_speakers or self._max_speakers
+
+        speaker_centroids: list[np.ndarray] = list()
+        speaker_counts: list[int] = list()
+        for chunk_start, chunk_end in zip(split_points[:-1], split_points[1:]):
+            offset = chunk_start / sample_rate
+            chunk_end_time = chunk_end / sample_rate
+            _logger.debug(
+                f"diarization chunk: [{offset:03.1f}s - {chunk_end_time:03.1f}s]"
+            )
+            diarization, embeddings = pipeline(
+                {
+                    "waveform": tensor[:, chunk_start:chunk_end],
+                    "sample_rate": sample_rate,
+                },
+                max_speakers=max_speakers,
+                return_embeddings=True,
+            )
+
+            # 分割区間の話者ラベルを全体の話者ラベルへ対応付ける
+            chunk_labels = diarization.labels()
+            label_map: dict[str, str] = dict()
+            similarities = _cosine_similarity(embeddings, speaker_centroids)
+            assigned: set[int] = set()
+            for chunk_index, global_index in _greedy_match(
+                similarities, self._speaker_similarity_threshold
+            ):
+                label_map[chunk_labels[chunk_index]] = f"SPEAKER_{global_index:02d}"
+                count = speaker_counts[global_index]
+                speaker_centroids[global_index] = (
+                    speaker_centroids[global_index] * count + embeddings[chunk_index]
+                ) / (count + 1)
+                speaker_counts[global_index] = count + 1
+                assigned.add(chunk_index)
+            for chunk_index, label in enumerate(chunk_labels):
+                if chunk_index in assigned:
+                    continue
+                if (
+                    max_global_speakers is not None
+                    and len(speaker_centroids) >= max_global_speakers
+                ):
+                    # 閾値未満でも最も類似する話者に割り当てる
+                    # 類似度の低い話者埋め込みで重心がずれないよう、重心は更新しない
+                    global_index = int(
+                        np.argmax(
+                            _cosine_similarity(
+                                embeddings[[chunk_index]], speaker_centroids
+                            )[0]
+                        )
+                    )
+                    label_map[label] = f"SPEAKER_{global_index:02d}"
+                    continue
+                label_map[label] = f"SPEAKER_{len(speaker_centroids):02d}"
+                speaker_centroids.append(embeddings[chunk_index])
+                speaker_counts.append(1)
+
+            for segment, _, speaker in diarization.itertracks(yield_label=True):
+                speaker_segment = SpeakerSegment(
+                    start_time=segment.start + offset,
+                    end_time=segment.end + offset,
+                    speaker_name=label_map[speaker],
+                )
+                yield speaker_segment
+
+
+def _default_batch_size(device_name: str) -> int:
+    """デバイスのメモリ量から推論時のバッチサイズを決める."""
+    if device_name != "cuda" or not torch.cuda.is_available():
+        return 32
+
+    total_memory = torch.cuda.get_device_properties(0).total_memory
+    if total_memory < 8 * 1024**3:
+        return 16
+    if total_memory < 16 * 1024**3:
+        return 32
+
+    return 64
+
+
+def _find_split_points(
+    waveform: torch.Tensor, sample_rate: int, max_chunk_duration: float
+) -> list[int]:
+    """最大長を超えないように、無音に近い位置で分割するサンプル位置を返す.
+
+    Notes
+    -----
+    100ms単位のフレームエネルギーを計算し、最大長の後半2割の範囲で最も小さいフレームで分割する。
+    """
+    frame_length = sample_rate // 10
+    num_samples = waveform.shape[-1]
+    num_frames = num_samples // frame_length
+    mono = waveform.mean(dim=0)[: num_frames * frame_length]
+    energy = mono.reshape(num_frames, frame_length).pow(2).mean(dim=1).numpy()
+
+    # 探索範囲が開始位置を含むと分割位置が進まなくなるため、最大長は2フレーム以上とする
+    max_frames = max(int(max_chunk_duration * 10), 2)
+    search_frames = max(max_frames // 5, 1)
+    split_points = [0]
+    start_frame = 0
+    while num_frames - start_frame > max_frames:
+        search_start = start_frame + max_frames - search_frames
+        search_end = start_frame + max_frames
+        split_frame = search_start + int(np.argmin(energy[search_start:search_end]))
+        split_points.append(split_frame * frame_length)
+        start_frame = split_frame
+    split_points.append(num_samples)
+
+    return split_points
+
+
+def _cosine_similarity(
+    embeddings: np.ndarray, centroids: list[np.ndarray]
+) -> np.ndarray:
+    """(分割区間の話者数, 全体の話者数)のコサイン類似度を返す. 計算できない場合は-1とする."""
+    if len(centroids) < 1:
+        return np.full((len(embeddings), 0), -1.0)
+
+    centroid_array = np.stack(centroids)
+    norm = np.linalg.norm(embeddings, axis=1, keepdims=True) * np.linalg.norm(
+        centroid_array, axis=1
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        similarities = embeddings @ centroid_array.T / norm
+
+    return np.nan_to_num(similarities, nan=-1.0)
+
+
+def _greedy_match(similarities: np.ndarray, threshold: float) -> list[tuple[int, int]]:
+    """類似度の高い組から順に、閾値以上の話者同士を1対1で対応付ける."""
+    matches: list[tuple[int, int]] = list()
+    used_rows: set[int] = set()
+    used_cols: set[int] = set()
+    for flat_index in np.argsort(similarities, axis=None)[::-1]:
+        row, col = np.unravel_index(flat_index, similarities.shape)
+        if similarities[row, col] < threshold:
+            break
+        if row in used_rows or col in used_cols:
+            continue
+        matches.append((int(row), int(col)))
+        used_rows.add(row)
+        used_cols.add(col)
+
+    return matches
+
+
+def _prepare_waveform(waveform: Waveform, device_name: str) -> torch.Tensor:
+    """pipelineの入力とするため、モノラルかつ16kHzの波形に変換する.
+
+    Notes
+    -----
+    pipeline内で変換するとCPUの1コアで処理されるため、指定したデバイスで変換してから渡す。
+    pipelineは推論時に入力をデバイスへ転送するため、変換後の波形はCPUに戻す。
+    """
+    tensor = waveform.tensor
+    if tensor.shape[0] == 1 and waveform.sample_rate == _PIPELINE_SAMPLE_RATE:
+        return tensor
+
+    tensor = tensor.to(torch.device(device_name)).mean(dim=0, keepdim=True)
+    if waveform.sample_rate != _PIPELINE_SAMPLE_RATE:
+        tensor = torchaudio.functional.resample(
+            tensor, waveform.sample_rate, _PIPELINE_SAMPLE_RATE
+        )
+
+    return tensor.cpu()
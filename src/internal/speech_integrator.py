@@ -1,5 +1,3 @@
-import os
-
 from internal.speaker_text import SpeakerText
 
 
@@ -24,6 +22,6 @@ class SpeechIntegrator:
                 continue
 
             current_text.end_time = segment.end_time
-            current_text.text += os.linesep + segment.text
+            current_text.text += "\n" + segment.text
 
         return integrated_speaker_text
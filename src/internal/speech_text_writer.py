@@ -1,4 +1,3 @@
-import os
 from pathlib import Path
 
 from internal.speaker_text import SpeakerText
@@ -15,18 +14,22 @@ class SpeechTextWriter:
             self._filepath.write_text("")
             return
 
-        # segmentごとの文字列を生成
-        segments = [
-            os.linesep.join(
-                [
-                    f"[{text.start_time:03.1f} --> {text.end_time:03.1f}] {text.speaker_name}",
+        # segmentごとの文字列を中間文字列を作らずに連結する
+        # 改行はプラットフォームによらず"\n"に固定する
+        parts: list[str] = list()
+        for text in speaker_text:
+            parts.extend(
+                (
+                    f"[{text.start_time:03.1f} --> {text.end_time:03.1f}]"
+                    f" {text.speaker_name}",
+                    "\n",
                     text.text,
-                ]
+                    "\n\n",
+                )
             )
-            for text in speaker_text
-        ]
+        parts.pop()  # 末尾のsegmentの後には空行を入れない
 
-        self._filepath.write_text(f"{(os.linesep)*2}".join(segments))
+        self._filepath.write_text("".join(parts), newline="\n")
 
     def clean(self) -> None:
         if not self._filepath.exists():
@@ -2,109 +2,162 @@ import logging
 import os
 import re
 import subprocess
+from collections import deque
+from collections.abc import Iterator
 from pathlib import Path
 
-from pydub import AudioSegment
-
 from internal.speaker_segment import SpeakerSegment
 from internal.speaker_text import SpeakerText
+from internal.timestamp_text import assign_by_center_time
 
 _logger = logging.getLogger(__name__)
 
 
 class SpeechToText:
+    # 書き起こし結果の行("[hh:mm:ss.mmm --> hh:mm:ss.mmm]  テキスト")
+    _re_query = re.compile(
+        r"\[(\d{2}):(\d{2}):(\d{2}\.\d{3}) --> (\d{2}):(\d{2}):(\d{2}\.\d{3})]"
+        r"\s+(.+)"
+    )
+
     def __init__(
-        self, wav_dirpath: Path, whisper_cpp_path: Path, model_name: str
+        self,
+        whisper_cpp_path: Path,
+        model_name: str,
+        quantization: str | None = None,
+        num_threads: int | None = None,
+        num_processors: int = 1,
+        beam_size: int = 1,
+        best_of: int = 1,
     ) -> None:
-        self._wav_dirpath = wav_dirpath
         self._whisper_cpp_path = whisper_cpp_path.resolve()
 
-        self._re_query = re.compile(
-            r"(\[\d{2}:\d{2}:\d{2}\.\d{3} --> \d{2}:\d{2}:\d{2}\.\d{3}])\s+(.+)"
-        )
         self._whisper_cpp_venv = self._whisper_cpp_path / ".venv/bin"
+        # whisper.cppの仮想環境はサブプロセスのみに設定し、自プロセスの環境変数は変更しない
+        self._child_env = {
+            **os.environ,
+            "PATH": f"{self._whisper_cpp_venv}{os.pathsep}{os.environ.get('PATH', '')}",
+        }
+        # 量子化したモデル(q5_0, q8_0など)はメモリ帯域が減るためCPUでの推論が速くなる
+        model_filename = (
+            f"ggml-{model_name}.bin"
+            if quantization is None
+            else f"ggml-{model_name}-{quantization}.bin"
+        )
+        self._model_filepath = whisper_cpp_path / "models" / model_filename
+        # オフラインでの書き起こしのため、ビームサーチの幅を絞り全コアを利用する
+        # num_processorsが2以上の場合は音源を分割して並列に推論し、コアをプロセッサ間で分け合う
+        # モデルの重みは並列の推論間で共有されるため、メモリは1モデル分で済む
+        if num_threads is None:
+            num_threads = max((os.cpu_count() or 4) // num_processors, 1)
         self._whisper_command = [
             str(whisper_cpp_path / "main"),
             "-m",
-            str(whisper_cpp_path / f"models/ggml-{model_name}.bin"),
+            str(self._model_filepath),
             "-l",
             "ja",
+            "-t",
+            str(num_threads),
+            "-p",
+            str(num_processors),
+            "-bs",
+            str(beam_size),
+            "-bo",
+            str(best_of),
         ]
 
+    def prefetch_model(self) -> None:
+        """whisper.cppのモデルファイルをページキャッシュへ先読みさせる.
+
+        Notes
+        -----
+        先読みはOSが非同期に行うため、話者分離などの前に呼んでおくと
+        whisper.cpp起動時のモデル読み込みを待たずに済む。
+        posix_fadviseが利用できない環境では何もしない。
+        """
+        if not hasattr(os, "posix_fadvise"):
+            return
+        if not self._model_filepath.exists():
+            _logger.warning(f"model file is not found: {self._model_filepath}")
+            return
+
+        fd = os.open(self._model_filepath, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
     def to_text(
-        self, sound: AudioSegment, segments: list[SpeakerSegment]
-    ) -> list[SpeakerText]:
-        """指定したwavファイルをテキスト化する."""
-        speaker_text_list: list[SpeakerText] = list()
-        for segment in segments:
-            start_time = int(segment.start_time * 1000)  # s -> ms
-            end_time = int(segment.end_time * 1000)  # s -> ms
-            sound_segment = sound[start_time:end_time]
-            try:
-                text = self._sound_segment_to_text(sound_segment)
-            except Exception:
-                _logger.exception(
-                    "Unhandled exception in speech to text. continue..."
-                    f" [{segment.start_time:03.1f}s - {segment.end_time:03.1f}s]"
-                    f" {segment.speaker_name}"
-                )
-                continue
+        self, wav_filepath: Path, segments: list[SpeakerSegment]
+    ) -> Iterator[SpeakerText]:
+        """指定したwavファイルをテキスト化する.
+
+        Notes
+        -----
+        whisper.cppのモデル読み込みを1回で済ませるため、音源全体を一度に書き起こし、
+        書き起こし結果の中央時刻が含まれる話者区間にテキストを割り当てる。
+        """
+        timestamp_texts = self._wav_to_text(wav_filepath)
+
+        for segment, text in assign_by_center_time(timestamp_texts, segments):
             speaker_text = SpeakerText(
                 start_time=segment.start_time,
                 end_time=segment.end_time,
                 speaker_name=segment.speaker_name,
                 text=text,
             )
-            speaker_text_list.append(speaker_text)
             _logger.debug(
                 f"[{segment.start_time:03.1f}s - {segment.end_time:03.1f}s]"
                 f" {segment.speaker_name} : {text}"
             )
+            yield speaker_text
 
-        return speaker_text_list
+    def _parse_line(self, line: str) -> tuple[float, float, str] | None:
+        """whisper.cppの出力1行を(開始時刻, 終了時刻, テキスト)に変換する. 対象外はNone."""
+        # 書き起こし結果の行は"[hh:mm:ss.mmm --> "で始まるため、それ以外は正規表現を使わず除外する
+        if not line.startswith("[") or line[13:18] != " --> ":
+            return None
+        line_str = self._re_query.match(line)
+        if line_str is None:
+            return None
+        start_h, start_m, start_s, end_h, end_m, end_s, text = line_str.groups()
+        start_time = int(start_h) * 3600 + int(start_m) * 60 + float(start_s)
+        end_time = int(end_h) * 3600 + int(end_m) * 60 + float(end_s)
 
-    def _sound_segment_to_text(self, sound: AudioSegment) -> str:
-        """1つ分のオーディオデータをテキスト化する."""
-        wav_filepath = self._wav_dirpath / "cut_export.wav"
-        sound.export(wav_filepath, format="wav")
+        return (start_time, end_time, text.rstrip())
 
-        old_path = os.environ["PATH"]
-        os.environ[
-            "PATH"
-        ] = f"{self._whisper_cpp_path}/.venv/bin:{os.environ.get('PATH')}"
+    def _wav_to_text(self, wav_filepath: Path) -> list[tuple[float, float, str]]:
+        """wavファイル全体をテキスト化し、(開始時刻, 終了時刻, テキスト)のリストを返す."""
         command_args = [
             *self._whisper_command,
             "-f",
-            str(wav_filepath),
+            str(wav_filepath.resolve()),
         ]
-        proc = subprocess.Popen(
+        # 書き起こし結果は出力された行から順に解析し、全文をメモリに溜めない
+        # 標準エラーは標準出力にまとめ、パイプが詰まらないようにする。エラー時は末尾のみ出力する
+        timestamp_texts: list[tuple[float, float, str]] = list()
+        log_lines: deque[str] = deque(maxlen=20)
+        with subprocess.Popen(
             command_args,
             encoding="utf-8",
+            env=self._child_env,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        try:
-            result, error = proc.communicate(timeout=1800)
-            if proc.returncode != 0:
-                _logger.error(f"command failed with exit status {proc.returncode}")
-                _logger.error(error)
-                raise ValueError("speech to text error.")
-        except Exception:
-            proc.kill()
-            raise
-        os.environ["PATH"] = old_path
-        wav_filepath.unlink()
-
-        result_lines = result.splitlines()
-        match_list: list[str] = list()
-        for line in result_lines:
-            line_str = self._re_query.search(line)
-            if line_str is None:
-                continue
-            if len(line_str.groups()) != 2:
-                _logger.warning(f"skip match string: num={len(line_str.groups())}")
-                continue
-            match_list.append(line_str.group(2))
-        match_str = " ".join(match_list)
-
-        return match_str
+            stderr=subprocess.STDOUT,
+        ) as proc:
+            assert proc.stdout is not None
+            try:
+                for line in proc.stdout:
+                    timestamp_text = self._parse_line(line)
+                    if timestamp_text is None:
+                        log_lines.append(line.rstrip())
+                        continue
+                    timestamp_texts.append(timestamp_text)
+            except Exception:
+                proc.kill()
+                raise
+        if proc.returncode != 0:
+            _logger.error(f"command failed with exit status {proc.returncode}")
+            _logger.error("\n".join(log_lines))
+            raise ValueError("speech to text error.")
+
+        return timestamp_texts
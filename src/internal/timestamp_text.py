@@ -0,0 +1,26 @@
+from bisect import bisect_left
+from collections.abc import Iterable, Iterator
+
+from internal.speaker_segment import SpeakerSegment
+
+
+def assign_by_center_time(
+    timestamp_texts: Iterable[tuple[float, float, str]],
+    segments: list[SpeakerSegment],
+) -> Iterator[tuple[SpeakerSegment, str]]:
+    """書き起こし結果を、中央時刻が含まれる話者区間に割り当てる.
+
+    Notes
+    -----
+    書き起こし結果は(開始時刻, 終了時刻, テキスト)とし、
+    同じ話者区間に割り当てられたテキストは空白で連結する。
+    隣接する区間の境界に重なる場合に重複して割り当てないよう、区間は終了時刻を含まない。
+    """
+    sorted_texts = sorted(timestamp_texts)
+    center_times = [(start + end) / 2 for start, end, _ in sorted_texts]
+
+    for segment in segments:
+        first = bisect_left(center_times, segment.start_time)
+        last = bisect_left(center_times, segment.end_time)
+        text = " ".join(text for _, _, text in sorted_texts[first:last])
+        yield segment, text
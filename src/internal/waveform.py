@@ -0,0 +1,69 @@
+from pathlib import Path
+
+import numpy as np
+import soundfile
+import torch
+import torchaudio
+
+
+class Waveform:
+    """wavファイルを一度だけデコードし、話者分離と書き起こしで共有する.
+
+    Notes
+    -----
+    16bit PCMとして一度だけ読み込み、pyannote向けの正規化した波形と
+    whisper向けのnumpy配列は読み込み済みのPCMから生成する。
+    """
+
+    def __init__(self, filepath: Path) -> None:
+        self._filepath = filepath
+
+        self._pcm: torch.Tensor | None = None  # (channel, time), int16
+        self._waveform: torch.Tensor | None = None  # (channel, time), float32
+        self._sample_rate = 0
+
+    @property
+    def sample_rate(self) -> int:
+        self._load()
+        return self._sample_rate
+
+    @property
+    def pcm(self) -> torch.Tensor:
+        """(channel, time)の形状の16bit PCM."""
+        self._load()
+        assert self._pcm is not None
+        return self._pcm
+
+    @property
+    def tensor(self) -> torch.Tensor:
+        """(channel, time)の形状で-1.0から1.0に正規化した波形."""
+        if self._waveform is None:
+            self._waveform = self.pcm.to(torch.float32) / 32768.0
+        return self._waveform
+
+    def to_numpy(self, sample_rate: int = 16000) -> np.ndarray:
+        """モノラルかつ指定したサンプリング周波数の16bit PCMを返す.
+
+        Notes
+        -----
+        変換が不要な場合は、コピーせずに読み込み済みのPCMのviewを返す。
+        """
+        if self.pcm.shape[0] == 1 and self.sample_rate == sample_rate:
+            return self.pcm[0].numpy()
+
+        waveform = torchaudio.functional.resample(
+            self.tensor.mean(dim=0), self.sample_rate, sample_rate
+        )
+
+        return (waveform * 32768.0).clamp(-32768, 32767).to(torch.int16).numpy()
+
+    def _load(self) -> None:
+        if self._pcm is not None:
+            return
+
+        # libsndfileで16bit PCMとして直接デコードする. 16bit PCM以外のwavも変換して読み込む
+        # (time, channel)の配列を転置したviewとし、コピーせずにtensorとして共有する
+        pcm, self._sample_rate = soundfile.read(
+            str(self._filepath), dtype="int16", always_2d=True
+        )
+        self._pcm = torch.from_numpy(pcm.T)
@@ -0,0 +1,185 @@
+import atexit
+import logging
+import re
+import socket
+import subprocess
+import time
+import uuid
+from collections.abc import Iterator
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from internal.speech_to_text import SpeechToText
+
+_logger = logging.getLogger(__name__)
+
+
+class WhisperCppServerSpeechToText(SpeechToText):
+    """whisper.cppのserverを常駐させて書き起こしを行う.
+
+    Notes
+    -----
+    serverはモデルを読み込んだまま常駐するため、複数のファイルを処理しても
+    モデルの読み込みは1回で済む。起動したserverはクラスで保持し、
+    同じ起動条件であればファイルをまたいで再利用する。
+    """
+
+    # vtt形式の書き起こし結果("hh:mm:ss.mmm --> hh:mm:ss.mmm"の次の行がテキスト)
+    _re_vtt_query = re.compile(
+        r"^(\d{2}):(\d{2}):(\d{2}\.\d{3}) --> (\d{2}):(\d{2}):(\d{2}\.\d{3})\n"
+        r"(.*)$",
+        re.MULTILINE,
+    )
+
+    _process: subprocess.Popen | None = None
+    _process_command: list[str] | None = None
+    _url = ""
+
+    def __init__(
+        self,
+        whisper_cpp_path: Path,
+        model_name: str,
+        quantization: str | None = None,
+        num_threads: int | None = None,
+        num_processors: int = 1,
+        beam_size: int = 1,
+        best_of: int = 1,
+        startup_timeout: float = 600.0,
+    ) -> None:
+        super().__init__(
+            whisper_cpp_path,
+            model_name,
+            quantization=quantization,
+            num_threads=num_threads,
+            num_processors=num_processors,
+            beam_size=beam_size,
+            best_of=best_of,
+        )
+
+        self._server_command = [
+            str(whisper_cpp_path.resolve() / "server"),
+            *self._whisper_command[1:],
+        ]
+        self._startup_timeout = startup_timeout  # 秒
+
+    @classmethod
+    def stop(cls) -> None:
+        """常駐しているserverを停止する."""
+        if cls._process is None:
+            return
+
+        cls._process.terminate()
+        try:
+            cls._process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            cls._process.kill()
+            cls._process.wait()
+        cls._process = None
+        cls._process_command = None
+
+    @classmethod
+    def _get_server(
+        cls, command: list[str], env: dict[str, str], startup_timeout: float
+    ) -> str:
+        """起動済みのserverのURLを返す. 未起動または条件が異なる場合は起動し直す."""
+        if (
+            cls._process is not None
+            and cls._process.poll() is None
+            and cls._process_command == command
+        ):
+            return cls._url
+
+        cls.stop()
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        _logger.info(f"start whisper.cpp server: port={port}")
+        # serverのログは利用しないため、パイプが詰まらないよう破棄する
+        cls._process = subprocess.Popen(
+            [*command, "--host", "127.0.0.1", "--port", str(port)],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        cls._process_command = command
+        cls._url = f"http://127.0.0.1:{port}"
+
+        # モデルの読み込みが終わると接続を受け付けるため、応答が返るまで待つ
+        deadline = time.monotonic() + startup_timeout
+        while True:
+            if cls._process.poll() is not None:
+                cls.stop()
+                raise ValueError("whisper.cpp server exited.")
+            try:
+                with urlopen(cls._url, timeout=1):
+                    break
+            except HTTPError:
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    cls.stop()
+                    raise ValueError("whisper.cpp server did not start.")
+                time.sleep(1)
+
+        return cls._url
+
+    def _wav_to_text(self, wav_filepath: Path) -> list[tuple[float, float, str]]:
+        """wavファイル全体をserverで書き起こし、(開始時刻, 終了時刻, テキスト)のリストを返す."""
+        url = self._get_server(
+            self._server_command, self._child_env, self._startup_timeout
+        )
+
+        # 数時間の音源ではwavファイルが数百MBになるため、メモリに読み込まず送信する
+        boundary = uuid.uuid4().hex
+        head = b"".join(
+            [
+                f"--{boundary}\r\n".encode(),
+                b'Content-Disposition: form-data; name="response_format"\r\n\r\n',
+                b"vtt\r\n",
+                f"--{boundary}\r\n".encode(),
+                b'Content-Disposition: form-data; name="file"; filename="audio.wav"',
+                b"\r\n",
+                b"Content-Type: audio/wav\r\n\r\n",
+            ]
+        )
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        content_length = len(head) + wav_filepath.stat().st_size + len(tail)
+        request = Request(
+            f"{url}/inference",
+            data=_iter_body(head, wav_filepath, tail),
+            headers={
+                "Content-Type": f"multipart/form-data; boundary={boundary}",
+                "Content-Length": str(content_length),
+            },
+        )
+        try:
+            with urlopen(request) as response:
+                result = response.read().decode("utf-8")
+        except OSError as e:
+            _logger.error(f"whisper.cpp server request failed: {e}")
+            raise ValueError("speech to text error.") from e
+
+        timestamp_texts: list[tuple[float, float, str]] = list()
+        for match in self._re_vtt_query.finditer(result):
+            start_h, start_m, start_s, end_h, end_m, end_s, text = match.groups()
+            start_time = int(start_h) * 3600 + int(start_m) * 60 + float(start_s)
+            end_time = int(end_h) * 3600 + int(end_m) * 60 + float(end_s)
+            timestamp_texts.append((start_time, end_time, text.strip()))
+
+        return timestamp_texts
+
+
+def _iter_body(
+    head: bytes, filepath: Path, tail: bytes, chunk_size: int = 1024 * 1024
+) -> Iterator[bytes]:
+    """ファイルを一定サイズずつ読み込み、前後のデータと合わせて順に返す."""
+    yield head
+    with filepath.open("rb") as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+    yield tail
+
+
+# 常駐したserverが残らないよう、終了時に停止する
+atexit.register(WhisperCppServerSpeechToText.stop)
@@ -1,12 +1,19 @@
 """フォルダ内を探索して音声ファイルに対して文字起こしを実施する."""
+import atexit
+import hashlib
 import logging
+import os
 import shutil
 import sys
 from argparse import ArgumentParser
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from logging import Formatter, StreamHandler
-from logging.handlers import RotatingFileHandler
+from logging import Formatter, Handler, StreamHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from multiprocessing import Queue
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 from internal import (
     ConvertToMp4File,
@@ -14,15 +21,17 @@ from internal import (
     SpeakerIntegrator,
     SpeakerSegment,
     SpeakerSegmentFile,
-    SpeakerSeperator,
     SpeakerText,
     SpeechIntegrator,
     SpeechTextFile,
     SpeechTextWriter,
     SpeechToText,
+    WhisperCppServerSpeechToText,
 )
 from pydantic import BaseModel
-from pydub import AudioSegment
+
+if TYPE_CHECKING:
+    from internal import SpeakerSeperator, Waveform
 
 _logger = logging.getLogger(__name__)
 
@@ -35,20 +44,33 @@ class _DeviceType(Enum):
     MPS = "mps"
 
 
+class _SpeechToTextBackend(Enum):
+    """書き起こしに利用する実装."""
+
+    WHISPER_CPP = "whisper-cpp"
+    WHISPER_CPP_SERVER = "whisper-cpp-server"
+    FASTER_WHISPER = "faster-whisper"
+
+
 class _RunConfig(BaseModel):
     """スクリプト実行のためのオプション."""
 
     root_dir: Path  # 処理対象を探索するルートフォルダ
     device: str  # デバイス
+    backend: str  # 書き起こしに利用する実装
+    model_name: str  # 書き起こしに利用するwhisperのモデル名
+    quantization: str | None  # whisper.cppで利用するモデルの量子化. 量子化しない場合はNone.
+    num_processors: int  # whisper.cppで並列に推論するプロセッサ数
+    batch_size: int  # faster-whisperでまとめて推論する区間数
+    playback_speed: float  # faster-whisperで長い区間を推論する際の再生速度
 
     force: bool  # 保存済みのファイルを無視して実行するかどうか
     verbose: int  # ログレベル
 
 
 def _calc_speaker_segment(
-    wav_filepath: Path,
-    model_config_filepath: Path,
-    device: str,
+    waveform: "Waveform",
+    speaker_seperator: "SpeakerSeperator",
     segment_filepath: Path,
     force: bool = False,
 ) -> list[SpeakerSegment]:
@@ -58,28 +80,28 @@ def _calc_speaker_segment(
         # 既存データがあり、強制再計算でなければ算出済みの結果を返す
         return speaker_segments
 
-    speaker_seperator = SpeakerSeperator(
-        config_path=model_config_filepath, device_name=device
-    )
-    for segment in speaker_seperator.diarization(wav_filepath=wav_filepath):
+    # 話者分離は途中から再開できないため、作業中の結果は破棄して最初から実行する
+    speaker_segment_file.clean()
+    speaker_segments = list()
+    for segment in speaker_seperator.diarization(waveform=waveform):
         _logger.debug(
             f"[{segment.start_time:03.1f}s - {segment.end_time:03.1f}s]"
             f" {segment.speaker_name}"
         )
+        # 中断した場合に備えて1区間ずつ保存する
+        speaker_segment_file.append(segment)
         speaker_segments.append(segment)
-
-    # 計算結果を保存
-    speaker_segment_file.save(speaker_segments)
+    speaker_segment_file.complete()
 
     return speaker_segments
 
 
-def _convert_to_mp4_file(source_filepath: Path, output_dir: Path) -> Path:
+def _convert_to_mp4_file(source_filepath: Path, output_dir: Path, device: str) -> Path:
     """mp4ファイルへ変換し、変換後のファイルパスを返す."""
     if source_filepath.suffix == ".mp4":
         return source_filepath
 
-    convert_to_mp4file = ConvertToMp4File(output_dir=output_dir)
+    convert_to_mp4file = ConvertToMp4File(output_dir=output_dir, device_name=device)
     target_filepath = convert_to_mp4file.convert(source_filepath)
 
     return target_filepath
@@ -93,6 +115,46 @@ def _convert_to_wav_file(source_filepath: Path, output_dir: Path) -> Path:
     return target_filepath
 
 
+def _find_target_files(root_dir: Path, allowed_suffix: list[str]) -> Iterator[Path]:
+    """フォルダ内を探索し、書き起こしていない特定拡張子のファイルを返す.
+
+    Notes
+    -----
+    os.scandirでフォルダ単位にファイル名を取得し、出力ファイルの有無はファイル名で判定する。
+    """
+    dir_stack = [str(root_dir)]
+    while len(dir_stack) > 0:
+        with os.scandir(dir_stack.pop()) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        filenames = {entry.name for entry in entries}
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                dir_stack.append(entry.path)
+                continue
+            stem, suffix = os.path.splitext(entry.name)
+            # 特定拡張子のファイルのみ処理対象とする
+            if suffix not in allowed_suffix:
+                continue
+            # 既に出力ファイルがある場合は処理を行わない
+            if f"{stem}.txt" in filenames:
+                _logger.info(f"speech text is already exist. skip: {entry.path}")
+                continue
+            yield Path(entry.path)
+
+
+def _get_work_dirname(filepath: Path) -> str:
+    """作業フォルダ名を返す.
+
+    Notes
+    -----
+    別フォルダに同名のファイルがあっても変換を先行して実行できるよう、
+    ファイル名にフルパスのハッシュを付与してファイルごとに異なるフォルダとする。
+    """
+    path_hash = hashlib.sha1(str(filepath.resolve()).encode("utf-8")).hexdigest()
+
+    return f"{filepath.stem}-{path_hash[:8]}"
+
+
 def _integrate_speaker(
     speaker_segments: list[SpeakerSegment],
     speaker_segment_filepath: Path,
@@ -135,98 +197,60 @@ def _main() -> None:
     _setup_logger(log_filepath, loglevel=loglevel)
     _logger.info(config)
 
-    filepath_list = config.root_dir.glob("**/*")
-    allowed_suffix = [".mp4", ".mkv"]
-    for filepath in filepath_list:
-        # 特定拡張子のファイルのみ処理対象とする
-        if filepath.is_dir():
-            continue
-        if filepath.suffix not in allowed_suffix:
-            continue
-        _logger.info(f"target file: {filepath}")
-
-        # データフォルダ
-        raw_dir = Path("data/raw")
-        interim_dir = Path("data/interim") / filepath.stem
-        interim_dir.mkdir(exist_ok=True)
-        processed_dir = Path("data/processed") / filepath.stem
-        processed_dir.mkdir(exist_ok=True)
-
-        # 入力用の固定値
-        model_config_filepath = raw_dir / "config.yaml"
-
-        # 出力ファイル情報
-        segment_filepath = interim_dir / "speaker_segment.json"
-        speaker_segment_filepath = interim_dir / "speaker_segment_integrate.json"
-        speech_text_filepath = interim_dir / "speech_text.json"
-        integrated_text_filepath = interim_dir / "speech_integrate_text.json"
-        result_filepath = processed_dir / f"{filepath.stem}.txt"
-        dst_filepath = filepath.parent / f"{filepath.stem}.txt"
-
-        # 既に出力ファイルがある場合は処理を行わない
-        if dst_filepath.exists():
-            _logger.info("speech text is already exist. skip.")
-            continue
-
-        # mp4ファイルへの変更
-        _logger.info(f"convert to mp4 file: {filepath.name}")
-        filepath_internal_mp4 = _convert_to_mp4_file(filepath, interim_dir)
-        if filepath_internal_mp4 != filepath:
-            filepath_mp4 = filepath.parent / filepath_internal_mp4.name
-            filepath_internal_mp4.rename(filepath_mp4)
-        # wavファイルへの変更
-        _logger.info(f"convert to wav file: {filepath.name}")
-        target_filepath = _convert_to_wav_file(filepath, interim_dir)
-        # 話者分離情報の取得
-        _logger.info("calc speaker segment ...")
-        speaker_segments = _calc_speaker_segment(
-            wav_filepath=target_filepath,
-            model_config_filepath=model_config_filepath,
-            device=config.device,
-            segment_filepath=segment_filepath,
-            force=config.force,
-        )
-        # 話者区間の統合
-        _logger.info("calc integrated speaker segment ...")
-        integrated_segements = _integrate_speaker(
-            speaker_segments=speaker_segments,
-            speaker_segment_filepath=speaker_segment_filepath,
-            force=config.force,
-        )
-        # Speech to Text
-        _logger.info("speech to text ...")
-        speech_text_list = _speach_to_text(
-            wav_fileapth=target_filepath,
-            speaker_segments=integrated_segements,
-            speech_text_filepath=speech_text_filepath,
-            temp_dir=interim_dir,
-            force=config.force,
-        )
-        # 冗長なテキストなどの除去
-        _logger.info("integrate text ...")
-        try:
-            integrated_text = _remove_redundant_text(
-                speaker_texts=speech_text_list,
-                save_filepath=integrated_text_filepath,
-                force=config.force,
-            )
-        except Exception:
-            message = "Unexpected error occurred while integrating text. skip this file."
-            _logger.exception(message)
-            continue
-        # ファイル出力
-        speech_md_file = SpeechTextWriter(filepath=result_filepath)
-        if config.force:
-            speech_md_file.clean()
-        speech_md_file.save(integrated_text)
-        # 入力ファイルのフォルダに出力ファイルを生成
-        _logger.info(f"save speech text: {dst_filepath}")
-        shutil.copy(result_filepath, dst_filepath)
-        # 中間ファイルを削除
-        _logger.info(f"remove intermediate files: {result_filepath}, {interim_dir}, {processed_dir}")
-        shutil.rmtree(interim_dir)
-        result_filepath.unlink()
-        shutil.rmtree(processed_dir)
+    # 話者分離の間にwhisper.cppのモデルをページキャッシュへ読み込ませておく
+    if config.backend != _SpeechToTextBackend.FASTER_WHISPER.value:
+        SpeechToText(
+            whisper_cpp_path=Path("whisper.cpp"),
+            model_name=config.model_name,
+            quantization=config.quantization,
+            num_processors=config.num_processors,
+        ).prefetch_model()
+
+    # 話者分離のモデルはファイルをまたいで共有する
+    # torchの読み込みには時間がかかるため、利用する時点で読み込む
+    from internal import SpeakerSeperator
+
+    raw_dir = Path("data/raw")
+    speaker_seperator = SpeakerSeperator(
+        config_path=raw_dir / "config.yaml", device_name=config.device
+    )
+
+    # 処理対象のファイルを列挙する
+    target_list = list(_find_target_files(config.root_dir, [".mp4", ".mkv"]))
+
+    # ffmpegによる変換はCPUで処理するため、後続ファイルの変換をワーカーで先行して実行する
+    # 話者分離と書き起こしはGPUを利用するため、メインプロセスで1ファイルずつ処理する
+    # 変換済みのwavファイルが溜まりすぎないよう、先行して変換するファイル数は制限する
+    num_workers = max(min(len(target_list), 2), 1)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(_prepare_file, filepath, config.device)
+            for filepath in target_list[:num_workers]
+        ]
+        for index, filepath in enumerate(target_list):
+            next_index = index + num_workers
+            if next_index < len(target_list):
+                futures.append(
+                    executor.submit(
+                        _prepare_file, target_list[next_index], config.device
+                    )
+                )
+
+            _logger.info(f"target file: {filepath}")
+            # 1ファイルの失敗で全体を止めないよう、エラーはファイル単位で記録して次へ進む
+            try:
+                target_filepath = futures[index].result()
+                _process_file(
+                    config,
+                    speaker_seperator=speaker_seperator,
+                    filepath=filepath,
+                    target_filepath=target_filepath,
+                )
+            except Exception:
+                _logger.exception(
+                    f"Unexpected error occurred while processing {filepath}."
+                    " skip this file."
+                )
 
 
 def _parse_args() -> _RunConfig:
@@ -241,6 +265,41 @@ def _parse_args() -> _RunConfig:
         choices=[v.value for v in _DeviceType],
         help="話者分離に利用するデバイス.",
     )
+    parser.add_argument(
+        "-b",
+        "--backend",
+        default=_SpeechToTextBackend.WHISPER_CPP.value,
+        choices=[v.value for v in _SpeechToTextBackend],
+        help="書き起こしに利用する実装.",
+    )
+    parser.add_argument(
+        "-m", "--model-name", default="large-v3", help="書き起こしに利用するwhisperのモデル名."
+    )
+    parser.add_argument(
+        "-q",
+        "--quantization",
+        default=None,
+        help="whisper.cppで利用するモデルの量子化(q5_0, q8_0など).",
+    )
+    parser.add_argument(
+        "-p",
+        "--num-processors",
+        type=int,
+        default=1,
+        help="whisper.cppで音源を分割して並列に推論するプロセッサ数.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="faster-whisperでまとめて推論する区間数. 1の場合は区間ごとに推論する.",
+    )
+    parser.add_argument(
+        "--playback-speed",
+        type=float,
+        default=1.0,
+        help="faster-whisperで長い区間を推論する際の再生速度(1.1から1.3程度).",
+    )
 
     parser.add_argument(
         "-f", "--force", action="store_true", help="算出済みの結果を無視して実行するかどうか."
@@ -255,6 +314,112 @@ def _parse_args() -> _RunConfig:
     return config
 
 
+def _prepare_file(filepath: Path, device: str) -> Path:
+    """作業フォルダを作成してwavファイルへ変換し、変換後のファイルパスを返す."""
+    work_dirname = _get_work_dirname(filepath)
+    interim_dir = Path("data/interim") / work_dirname
+    interim_dir.mkdir(exist_ok=True)
+    processed_dir = Path("data/processed") / work_dirname
+    processed_dir.mkdir(exist_ok=True)
+
+    # mp4ファイルへの変更
+    _logger.info(f"convert to mp4 file: {filepath.name}")
+    filepath_internal_mp4 = _convert_to_mp4_file(filepath, interim_dir, device=device)
+    if filepath_internal_mp4 != filepath:
+        filepath_mp4 = filepath.parent / filepath_internal_mp4.name
+        filepath_internal_mp4.rename(filepath_mp4)
+    # wavファイルへの変更
+    _logger.info(f"convert to wav file: {filepath.name}")
+    target_filepath = _convert_to_wav_file(filepath, interim_dir)
+
+    return target_filepath
+
+
+def _process_file(
+    config: _RunConfig,
+    speaker_seperator: "SpeakerSeperator",
+    filepath: Path,
+    target_filepath: Path,
+) -> None:
+    """変換済みのwavファイルから話者分離と書き起こしを行い、テキストを出力する."""
+    # データフォルダ
+    work_dirname = _get_work_dirname(filepath)
+    interim_dir = Path("data/interim") / work_dirname
+    processed_dir = Path("data/processed") / work_dirname
+
+    # 出力ファイル情報
+    segment_filepath = interim_dir / "speaker_segment.jsonl"
+    speaker_segment_filepath = interim_dir / "speaker_segment_integrate.jsonl"
+    speech_text_filepath = interim_dir / "speech_text.jsonl"
+    integrated_text_filepath = interim_dir / "speech_integrate_text.jsonl"
+    result_filepath = processed_dir / f"{filepath.stem}.txt"
+    dst_filepath = filepath.parent / f"{filepath.stem}.txt"
+
+    from internal import Waveform
+
+    # 話者分離と書き起こしで共有するため、wavファイルのデコードは一度だけ行う
+    waveform = Waveform(target_filepath)
+    # 話者分離情報の取得
+    _logger.info("calc speaker segment ...")
+    speaker_segments = _calc_speaker_segment(
+        waveform=waveform,
+        speaker_seperator=speaker_seperator,
+        segment_filepath=segment_filepath,
+        force=config.force,
+    )
+    # 話者区間の統合
+    _logger.info("calc integrated speaker segment ...")
+    integrated_segements = _integrate_speaker(
+        speaker_segments=speaker_segments,
+        speaker_segment_filepath=speaker_segment_filepath,
+        force=config.force,
+    )
+    # Speech to Text
+    _logger.info("speech to text ...")
+    speech_text_list = _speach_to_text(
+        wav_fileapth=target_filepath,
+        waveform=waveform,
+        speaker_segments=integrated_segements,
+        speech_text_filepath=speech_text_filepath,
+        device=config.device,
+        backend=config.backend,
+        model_name=config.model_name,
+        quantization=config.quantization,
+        num_processors=config.num_processors,
+        batch_size=config.batch_size,
+        playback_speed=config.playback_speed,
+        force=config.force,
+    )
+    # 書き起こし後は音源を利用しないため、デコード済みの波形とwavファイルを先に解放する
+    del waveform
+    target_filepath.unlink(missing_ok=True)
+    # 冗長なテキストなどの除去
+    _logger.info("integrate text ...")
+    try:
+        integrated_text = _remove_redundant_text(
+            speaker_texts=speech_text_list,
+            save_filepath=integrated_text_filepath,
+            force=config.force,
+        )
+    except Exception:
+        message = "Unexpected error occurred while integrating text. skip this file."
+        _logger.exception(message)
+        return
+    # ファイル出力
+    speech_md_file = SpeechTextWriter(filepath=result_filepath)
+    if config.force:
+        speech_md_file.clean()
+    speech_md_file.save(integrated_text)
+    # 入力ファイルのフォルダに出力ファイルを移動する
+    # 同じファイルシステムであればリネームのみで済み、異なる場合はコピーして削除する
+    _logger.info(f"save speech text: {dst_filepath}")
+    shutil.move(result_filepath, dst_filepath)
+    # 中間ファイルを削除
+    _logger.info(f"remove intermediate files: {interim_dir}, {processed_dir}")
+    shutil.rmtree(interim_dir)
+    shutil.rmtree(processed_dir)
+
+
 def _remove_redundant_text(
     speaker_texts: list[SpeakerText], save_filepath: Path, force: bool = False
 ) -> list[SpeakerText]:
@@ -293,8 +458,7 @@ def _setup_logger(
     console_handler.setFormatter(
         Formatter("[%(levelname)7s] %(asctime)s (%(name)s) %(message)s")
     )
-    _logger.addHandler(console_handler)
-    lib_logger.addHandler(console_handler)
+    handlers: list[Handler] = [console_handler]
 
     # ファイル出力するログ
     # 基本的に大量に利用することを想定していないので、ログファイルは多くは残さない。
@@ -310,15 +474,32 @@ def _setup_logger(
         file_handler.setFormatter(
             Formatter("[%(levelname)7s] %(asctime)s (%(name)s) %(message)s")
         )
-        _logger.addHandler(file_handler)
-        lib_logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    # ログの書き込みはバックグラウンドのスレッドで行い、推論などの処理を待たせない
+    # ワーカープロセスのログも受け取れるよう、プロセス間で共有できるキューを利用する
+    log_queue: Queue = Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    _logger.addHandler(queue_handler)
+    lib_logger.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # 終了時にキューに残ったログを書き出す
+    atexit.register(listener.stop)
 
 
 def _speach_to_text(
     wav_fileapth: Path,
+    waveform: "Waveform",
     speaker_segments: list[SpeakerSegment],
     speech_text_filepath: Path,
-    temp_dir: Path,
+    device: str,
+    backend: str,
+    model_name: str,
+    quantization: str | None,
+    num_processors: int,
+    batch_size: int,
+    playback_speed: float,
     force: bool = False,
 ) -> list[SpeakerText]:
     speech_text_file = SpeechTextFile(speech_text_filepath)
@@ -327,15 +508,51 @@ def _speach_to_text(
         # 強制再計算ではなく、既存の結果を読み込める場合は、計算済みの結果を返す
         return speaker_text_list
 
-    sound: AudioSegment = AudioSegment.from_wav(wav_fileapth)
-    speech_to_text = SpeechToText(
-        wav_dirpath=temp_dir,
-        whisper_cpp_path=Path("whisper.cpp"),
-        model_name="large-v3",
-    )
-    speaker_text_list = speech_to_text.to_text(sound=sound, segments=speaker_segments)
-
-    speech_text_file.save(speaker_text_list)
+    if force:
+        speech_text_file.clean()
+    # 中断した書き起こしがあれば、書き起こし済みの区間は除いて再開する
+    speaker_text_list = speech_text_file.get_partial_segment_list()
+    transcribed_keys = {
+        (text.start_time, text.speaker_name) for text in speaker_text_list
+    }
+    remaining_segments = [
+        segment
+        for segment in speaker_segments
+        if (segment.start_time, segment.speaker_name) not in transcribed_keys
+    ]
+    if backend == _SpeechToTextBackend.FASTER_WHISPER.value:
+        # faster-whisperはwhisper.cppを利用する場合に不要なため、選択された場合のみ読み込む
+        from internal import FasterWhisperSpeechToText
+
+        faster_whisper = FasterWhisperSpeechToText(
+            model_name=model_name,
+            device_name=device,
+            batch_size=batch_size,
+            playback_speed=playback_speed,
+        )
+        speaker_texts = faster_whisper.to_text(
+            waveform=waveform, segments=remaining_segments
+        )
+    else:
+        # serverは常駐させ、モデルを読み込み直さずに複数ファイルで再利用する
+        speech_to_text_class = (
+            WhisperCppServerSpeechToText
+            if backend == _SpeechToTextBackend.WHISPER_CPP_SERVER.value
+            else SpeechToText
+        )
+        speech_to_text = speech_to_text_class(
+            whisper_cpp_path=Path("whisper.cpp"),
+            model_name=model_name,
+            quantization=quantization,
+            num_processors=num_processors,
+        )
+        speaker_texts = speech_to_text.to_text(
+            wav_filepath=wav_fileapth, segments=remaining_segments
+        )
+    for speaker_text in speaker_texts:
+        speech_text_file.append(speaker_text)
+        speaker_text_list.append(speaker_text)
+    speech_text_file.complete()
 
     return speaker_text_list
 
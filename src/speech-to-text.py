@@ -1,24 +1,27 @@
 """pyannote-audio v3を利用して話者分離を実施する."""
+import atexit
 import logging
+import os
 import sys
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
-from logging import Formatter, StreamHandler
-from logging.handlers import RotatingFileHandler
+from logging import Formatter, Handler, StreamHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from multiprocessing import Queue
 from pathlib import Path
 
 from pydantic import BaseModel
-from pydub import AudioSegment
 
 from internal import (
     ConvertToWavFile,
     SpeakerIntegrator,
     SpeakerSegmentFile,
-    SpeakerSeperator,
     SpeechIntegrator,
     SpeechTextFile,
     SpeechTextWriter,
     SpeechToText,
+    WhisperCppServerSpeechToText,
 )
 
 _logger = logging.getLogger(__name__)
@@ -32,16 +35,48 @@ class _DeviceType(Enum):
     MPS = "mps"
 
 
+class _SpeechToTextBackend(Enum):
+    """書き起こしに利用する実装."""
+
+    WHISPER_CPP = "whisper-cpp"
+    WHISPER_CPP_SERVER = "whisper-cpp-server"
+    FASTER_WHISPER = "faster-whisper"
+
+
 class _RunConfig(BaseModel):
     """スクリプト実行のためのオプション."""
 
-    filepath: Path  # 処理対象の音源
+    filepath: list[Path]  # 処理対象の音源
     device: str  # デバイス
+    backend: str  # 書き起こしに利用する実装
+    model_name: str  # 書き起こしに利用するwhisperのモデル名
+    quantization: str | None  # whisper.cppで利用するモデルの量子化. 量子化しない場合はNone.
+    num_processors: int  # whisper.cppで並列に推論するプロセッサ数
+    batch_size: int  # faster-whisperでまとめて推論する区間数
+    playback_speed: float  # faster-whisperで長い区間を推論する際の再生速度
+    num_speakers: int | None  # 話者数. 不明な場合はNone.
+    min_speakers: int | None  # 最小話者数. 不明な場合はNone.
+    max_speakers: int | None  # 最大話者数. 不明な場合はNone.
+    chunk_duration: float | None  # 話者分離で分割する最大長(秒). 分割しない場合はNone.
 
     force: bool  # 保存済みのファイルを無視して実行するかどうか
     verbose: int  # ログレベル
 
 
+def _convert_to_wav_file(filepath: Path) -> Path:
+    """wavファイルへ変換し、変換後のファイルパスを返す."""
+    if filepath.suffix == ".wav":
+        return filepath
+
+    interim_dir = Path("data/interim") / filepath.stem
+    interim_dir.mkdir(exist_ok=True)
+    _logger.info(f"convert to wav file: {filepath.name}")
+    convert_to_wavfile = ConvertToWavFile(output_dir=interim_dir)
+    target_filepath = convert_to_wavfile.convert(filepath)
+
+    return target_filepath
+
+
 def _main() -> None:
     """スクリプトのエントリポイント."""
     # 実行時引数の読み込み
@@ -60,45 +95,165 @@ def _main() -> None:
     _setup_logger(log_filepath, loglevel=loglevel)
     _logger.info(config)
 
+    # 話者分離の間にwhisper.cppのモデルをページキャッシュへ読み込ませておく
+    if config.backend != _SpeechToTextBackend.FASTER_WHISPER.value:
+        SpeechToText(
+            whisper_cpp_path=Path("whisper.cpp"),
+            model_name=config.model_name,
+            quantization=config.quantization,
+            num_processors=config.num_processors,
+        ).prefetch_model()
+
+    # wavファイルへの変更
+    # ffmpegは1プロセスあたりCPUバウンドなため、複数ファイルの変換は並列に実行する
+    # 変換の失敗もファイル単位で扱えるよう、ファイルごとに変換を投入する
+    num_workers = max(min(len(config.filepath), (os.cpu_count() or 1) // 2), 1)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(_convert_to_wav_file, filepath)
+            for filepath in config.filepath
+        ]
+
+        # 話者分離はGPUを利用するため、変換後のファイルごとに順番に処理する
+        for filepath, future in zip(config.filepath, futures):
+            _logger.info(f"target file: {filepath}")
+            # 1ファイルの失敗で全体を止めないよう、エラーはファイル単位で記録して次へ進む
+            try:
+                wav_filepath = future.result()
+                _process_file(config, filepath=filepath, target_filepath=wav_filepath)
+            except Exception:
+                _logger.exception(
+                    f"Unexpected error occurred while processing {filepath}."
+                    " skip this file."
+                )
+
+
+def _parse_args() -> _RunConfig:
+    """スクリプト実行のための引数を読み込む."""
+    parser = ArgumentParser(description="pyannote-audio v3を利用して話者分離を実施する.")
+
+    parser.add_argument("filepath", nargs="+", help="文字起こしする音源のファイルパス.")
+    parser.add_argument(
+        "-d",
+        "--device",
+        default=_DeviceType.CPU.value,
+        choices=[v.value for v in _DeviceType],
+        help="話者分離に利用するデバイス.",
+    )
+    parser.add_argument(
+        "-b",
+        "--backend",
+        default=_SpeechToTextBackend.WHISPER_CPP.value,
+        choices=[v.value for v in _SpeechToTextBackend],
+        help="書き起こしに利用する実装.",
+    )
+    parser.add_argument(
+        "-m", "--model-name", default="large-v3", help="書き起こしに利用するwhisperのモデル名."
+    )
+    parser.add_argument(
+        "-q",
+        "--quantization",
+        default=None,
+        help="whisper.cppで利用するモデルの量子化(q5_0, q8_0など).",
+    )
+    parser.add_argument(
+        "-p",
+        "--num-processors",
+        type=int,
+        default=1,
+        help="whisper.cppで音源を分割して並列に推論するプロセッサ数.",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help="faster-whisperでまとめて推論する区間数. 1の場合は区間ごとに推論する.",
+    )
+    parser.add_argument(
+        "--playback-speed",
+        type=float,
+        default=1.0,
+        help="faster-whisperで長い区間を推論する際の再生速度(1.1から1.3程度).",
+    )
+    parser.add_argument("--num-speakers", type=int, default=None, help="話者数.")
+    parser.add_argument("--min-speakers", type=int, default=None, help="最小話者数.")
+    parser.add_argument("--max-speakers", type=int, default=None, help="最大話者数.")
+    parser.add_argument(
+        "--chunk-duration",
+        type=float,
+        default=None,
+        help="長い音源を分割して話者分離する場合の最大長(秒).",
+    )
+
+    parser.add_argument(
+        "-f", "--force", action="store_true", help="算出済みの結果を無視して実行するかどうか."
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="count", default=0, help="詳細メッセージのレベルを設定."
+    )
+
+    args = parser.parse_args()
+    config = _RunConfig(**vars(args))
+    # 作業フォルダはファイル名ごとに作成し、変換は並列に行うため、同名のファイルは受け付けない
+    stems = [filepath.stem for filepath in config.filepath]
+    duplicated_stems = sorted({stem for stem in stems if stems.count(stem) > 1})
+    if len(duplicated_stems) > 0:
+        parser.error(f"duplicated file names are not allowed: {duplicated_stems}")
+    # pyannoteの推論窓(10秒)より短い区間では話者分離できないため、分割長の下限とする
+    if config.chunk_duration is not None and config.chunk_duration < 10.0:
+        parser.error("--chunk-duration must be at least 10 seconds.")
+
+    return config
+
+
+def _process_file(config: _RunConfig, filepath: Path, target_filepath: Path) -> None:
+    """wavファイルに変換済みの音源を書き起こす."""
     # データフォルダ
     raw_dir = Path("data/raw")
-    interim_dir = Path("data/interim") / config.filepath.stem
+    interim_dir = Path("data/interim") / filepath.stem
     interim_dir.mkdir(exist_ok=True)
-    processed_dir = Path("data/processed") / config.filepath.stem
+    processed_dir = Path("data/processed") / filepath.stem
     processed_dir.mkdir(exist_ok=True)
     model_config_filepath = raw_dir / "config.yaml"
 
-    # wavファイルへの変更
-    target_filepath = config.filepath
-    if target_filepath.suffix != ".wav":
-        _logger.info(f"convert to wav file: {target_filepath.name}")
-        convert_to_wavfile = ConvertToWavFile(output_dir=interim_dir)
-        target_filepath = convert_to_wavfile.convert(target_filepath)
+    # torchの読み込みには時間がかかるため、利用する時点で読み込む
+    from internal import SpeakerSeperator, Waveform
+
+    # 話者分離と書き起こしで共有するため、wavファイルのデコードは一度だけ行う
+    waveform = Waveform(target_filepath)
 
     # 話者分離情報の取得
     _logger.info("calc speaker segment ...")
     speaker_segment_file = SpeakerSegmentFile(
-        filepath=(interim_dir / "speaker_segment.json")
+        filepath=(interim_dir / "speaker_segment.jsonl")
     )
     if config.force:
         speaker_segment_file.clean()
     speaker_segments = speaker_segment_file.get_segment_list()
     if len(speaker_segments) < 1:
+        # 話者分離は途中から再開できないため、作業中の結果は破棄して最初から実行する
+        speaker_segment_file.clean()
         speaker_seperator = SpeakerSeperator(
-            config_path=model_config_filepath, device_name=config.device
+            config_path=model_config_filepath,
+            device_name=config.device,
+            num_speakers=config.num_speakers,
+            min_speakers=config.min_speakers,
+            max_speakers=config.max_speakers,
+            max_chunk_duration=config.chunk_duration,
         )
-        for segment in speaker_seperator.diarization(wav_filepath=target_filepath):
+        for segment in speaker_seperator.diarization(waveform=waveform):
             _logger.info(
                 f"[{segment.start_time:03.1f}s - {segment.end_time:03.1f}s]"
                 f" {segment.speaker_name}"
             )
+            speaker_segment_file.append(segment)
             speaker_segments.append(segment)
-        speaker_segment_file.save(speaker_segments)
+        speaker_segment_file.complete()
 
     # 話者区間の統合
     _logger.info("calc integrated speaker segment ...")
     speaker_integrate_file = SpeakerSegmentFile(
-        filepath=(interim_dir / "speaker_segment_integrate.json")
+        filepath=(interim_dir / "speaker_segment_integrate.jsonl")
     )
     if config.force:
         speaker_integrate_file.clean()
@@ -114,26 +269,59 @@ def _main() -> None:
 
     # Speech to Text
     _logger.info("speech to text ...")
-    speech_text_file = SpeechTextFile(filepath=(interim_dir / "speech_text.json"))
+    speech_text_file = SpeechTextFile(filepath=(interim_dir / "speech_text.jsonl"))
     if config.force:
         speech_text_file.clean()
     speaker_text_list = speech_text_file.get_segment_list()
     if len(speaker_text_list) < 1:
-        sound: AudioSegment = AudioSegment.from_wav(target_filepath)
-        speech_to_text = SpeechToText(
-            wav_dirpath=interim_dir,
-            whisper_cpp_path=Path("whisper.cpp"),
-            model_name="large-v3",
-        )
-        speaker_text_list = speech_to_text.to_text(
-            sound=sound, segments=integrated_segments
-        )
-        speech_text_file.save(speaker_text_list)
+        # 中断した書き起こしがあれば、書き起こし済みの区間は除いて再開する
+        speaker_text_list = speech_text_file.get_partial_segment_list()
+        transcribed_keys = {
+            (text.start_time, text.speaker_name) for text in speaker_text_list
+        }
+        remaining_segments = [
+            segment
+            for segment in integrated_segments
+            if (segment.start_time, segment.speaker_name) not in transcribed_keys
+        ]
+        if config.backend == _SpeechToTextBackend.FASTER_WHISPER.value:
+            # faster-whisperはwhisper.cppを利用する場合に不要なため、選択された場合のみ読み込む
+            from internal import FasterWhisperSpeechToText
+
+            faster_whisper = FasterWhisperSpeechToText(
+                model_name=config.model_name,
+                device_name=config.device,
+                batch_size=config.batch_size,
+                playback_speed=config.playback_speed,
+            )
+            speaker_texts = faster_whisper.to_text(
+                waveform=waveform, segments=remaining_segments
+            )
+        else:
+            # serverは常駐させ、モデルを読み込み直さずに複数ファイルで再利用する
+            speech_to_text_class = (
+                WhisperCppServerSpeechToText
+                if config.backend == _SpeechToTextBackend.WHISPER_CPP_SERVER.value
+                else SpeechToText
+            )
+            speech_to_text = speech_to_text_class(
+                whisper_cpp_path=Path("whisper.cpp"),
+                model_name=config.model_name,
+                quantization=config.quantization,
+                num_processors=config.num_processors,
+            )
+            speaker_texts = speech_to_text.to_text(
+                wav_filepath=target_filepath, segments=remaining_segments
+            )
+        for speaker_text in speaker_texts:
+            speech_text_file.append(speaker_text)
+            speaker_text_list.append(speaker_text)
+        speech_text_file.complete()
 
     # 冗長なテキストなどの除去
     _logger.info("integrate text ...")
     speech_integrate_file = SpeechTextFile(
-        filepath=(interim_dir / "speech_integrate_text.json")
+        filepath=(interim_dir / "speech_integrate_text.jsonl")
     )
     if config.force:
         speech_integrate_file.clean()
@@ -152,32 +340,6 @@ def _main() -> None:
     speech_md_file.save(integrated_text)
 
 
-def _parse_args() -> _RunConfig:
-    """スクリプト実行のための引数を読み込む."""
-    parser = ArgumentParser(description="pyannote-audio v3を利用して話者分離を実施する.")
-
-    parser.add_argument("filepath", help="文字起こしする音源のファイルパス.")
-    parser.add_argument(
-        "-d",
-        "--device",
-        default=_DeviceType.CPU.value,
-        choices=[v.value for v in _DeviceType],
-        help="話者分離に利用するデバイス.",
-    )
-
-    parser.add_argument(
-        "-f", "--force", action="store_true", help="算出済みの結果を無視して実行するかどうか."
-    )
-    parser.add_argument(
-        "-v", "--verbose", action="count", default=0, help="詳細メッセージのレベルを設定."
-    )
-
-    args = parser.parse_args()
-    config = _RunConfig(**vars(args))
-
-    return config
-
-
 def _setup_logger(
     filepath: Path | None,  # ログ出力するファイルパス. Noneの場合はファイル出力しない.
     loglevel: int,  # 出力するログレベル
@@ -199,8 +361,7 @@ def _setup_logger(
     console_handler.setFormatter(
         Formatter("[%(levelname)7s] %(asctime)s (%(name)s) %(message)s")
     )
-    _logger.addHandler(console_handler)
-    lib_logger.addHandler(console_handler)
+    handlers: list[Handler] = [console_handler]
 
     # ファイル出力するログ
     # 基本的に大量に利用することを想定していないので、ログファイルは多くは残さない。
@@ -216,8 +377,18 @@ def _setup_logger(
         file_handler.setFormatter(
             Formatter("[%(levelname)7s] %(asctime)s (%(name)s) %(message)s")
         )
-        _logger.addHandler(file_handler)
-        lib_logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+    # ログの書き込みはバックグラウンドのスレッドで行い、推論などの処理を待たせない
+    # ワーカープロセスのログも受け取れるよう、プロセス間で共有できるキューを利用する
+    log_queue: Queue = Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    _logger.addHandler(queue_handler)
+    lib_logger.addHandler(queue_handler)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # 終了時にキューに残ったログを書き出す
+    atexit.register(listener.stop)
 
 
 if __name__ == "__main__":